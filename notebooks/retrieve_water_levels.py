@@ -3,87 +3,223 @@ LT 2022
 '''
 
 import os
-import requests
+import shutil
+import asyncio
+import concurrent.futures
+import aiohttp
 import pandas as pd
-import csv
-import time
+import pyarrow as pa
+import pyarrow.dataset as ds
+import json
 import numpy as np
 import datetime
+import logging
+import time
+from pathlib import Path
+
+# log to stderr from this module only, leaving the root logger of the notebook untouched
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+if not logger.handlers:
+    logger.addHandler(logging.StreamHandler())
+    logger.propagate = False
+
+# maximum number of simultaneous requests to the NOAA API
+MAX_CONCURRENT_REQUESTS = 5
+# number of attempts per year when the API throttles us or has a transient failure
+MAX_RETRIES = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# responses are cached per station, year and datum; verified data keeps arriving for months after a year ends,
+# so only responses written at least a year after their year ended are immutable and never expire
+# bump the version subfolder whenever the cached layout changes, so stale files are never read
+CACHE_DIR = Path('~/.cache/noaa_wl/v2').expanduser()
+# time in seconds after which any other cached response is refreshed
+CACHE_TTL = 3600
 
-def process_API_request(year, station_id, datum='MSL'):
+async def _fetch(session, url, sem, backoff=0.5):
+    '''This function performs a single API request, retrying with an increasing backoff when the server throttles, fails or cannot be reached.
+    Args:
+        session (aiohttp.ClientSession): The session used to perform the request
+        url (str): The URL to request
+        sem (asyncio.Semaphore): Semaphore limiting the number of simultaneous requests
+        backoff (float): Initial waiting time in seconds after a HTTP 429 or 5xx response or a connection error, doubled after every retry
+
+    Returns:
+        content (bytes): The raw body of the response'''
+    async with sem:
+        for _ in range(MAX_RETRIES):
+            try:
+                async with session.get(url, headers={'Accept-Encoding': 'gzip'}) as r:
+                    if r.status not in RETRY_STATUSES:
+                        r.raise_for_status()
+                        return await r.read()
+            except aiohttp.ClientResponseError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                # connection and read errors are transient as well, retry after backoff
+                pass
+            await asyncio.sleep(backoff)
+            backoff *= 2
+    raise RuntimeError(f'Request failed after {MAX_RETRIES} attempts, giving up on {url}')
+
+async def process_API_request(session, sem, year, station_id, datum='MSL', verbose=False):
     '''This function generates the URL and performs and processes the API request. 
     Args:
+        session (aiohttp.ClientSession): The session used to perform the request
+        sem (asyncio.Semaphore): Semaphore limiting the number of simultaneous requests
         year (int): The year for which to request data
         station_id (int): The station id to request the data from
         datum (str): vertical reference datum, by default MSL
+        verbose (bool): If True, log every downloaded year
     
     Returns:
-        df (pandas dataframe): The data retrieved from the API request'''
+        waterlevel (pandas series): The water levels retrieved from the API request, indexed by datetime'''
+
+    # Return cached response if still valid
+    cache_file = CACHE_DIR / f'{station_id}_{year}_{datum}.parquet'
+    if cache_file.exists():
+        mtime = cache_file.stat().st_mtime
+        is_complete = datetime.date.fromtimestamp(mtime).year > year + 1
+        if is_complete or time.time() - mtime < CACHE_TTL:
+            return pd.read_parquet(cache_file)['waterlevel']
 
     # Construct URL and do the API request
     start_string = f'begin_date={year}0101'
     end_string = f'end_date={year}1231'
     station_string = f'station={station_id}'
-    url = f'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter?{start_string}&{end_string}&{station_string}&product=hourly_height&datum={datum}&time_zone=gmt&units=metric&format=csv'
-    response = requests.get(url=url)
+    url = f'https://api.tidesandcurrents.noaa.gov/api/prod/datagetter?{start_string}&{end_string}&{station_string}&product=hourly_height&datum={datum}&time_zone=gmt&units=metric&format=json'
+    content = await _fetch(session, url, sem)
     
-    # Allow time for download
-    # time.sleep(1)
-    print(f'Downloaded year {year}')
+    if verbose:
+        logger.info(f'Downloaded year {year}')
     
-    # Process response and convert to pandas dataframe
-    decoded_content = response.content.decode('utf-8')
-    cr = csv.reader(decoded_content.splitlines(), delimiter=',')
-    data = list(cr)
-    df = pd.DataFrame(data[1:], columns=data[0])
+    payload = json.loads(content)
 
-    
     # Check if data is found. If year is missing fill with NaN.
-    error_message = 'Error: No data was found. This product may not be offered at this station at the requested time.'
-    if df.iloc[0].name == error_message:
-        print(f'Year {year}: {error_message}')
-        df['Date Time'] = f'{year}-01-01 00:00'
-        df = df.set_index('Date Time', drop=True)
-        for col in df.columns:
-            df[col].iloc[0] = np.nan    
+    if 'error' in payload:
+        logger.warning(f'Year {year}: Error: {payload["error"]["message"]}')
+        times = [pd.Timestamp(f'{year}-01-01 00:00')]
+        values = [np.nan]
+    else:
+        # Process response, missing observations become nan
+        df = pd.DataFrame(payload['data'], columns=['t', 'v'])
+        times = pd.to_datetime(df['t'], format='%Y-%m-%d %H:%M')
+        values = pd.to_numeric(df['v'], errors='coerce')
+    waterlevel = pd.Series(
+        np.asarray(values, dtype='float32'), index=pd.DatetimeIndex(times, name='datetime'), name='waterlevel'
+    )
+
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    waterlevel.to_frame().to_parquet(cache_file)
+
+    return waterlevel   
 
-    # missing observations to nan
-    df = df.replace('', np.nan)      
+async def _gather_years(years, station_id, datum='MSL', verbose=False):
+    '''This function retrieves the data of all requested years concurrently.
+    Args:
+        years (iterable): The years for which to request data
+        station_id (int): The station id to request the data from
+        datum (str): vertical reference datum, by default MSL
+        verbose (bool): If True, log every downloaded year
 
-    return df   
+    Returns:
+        retrieved_data (dict): The data retrieved per year'''
+    sem = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    timeout = aiohttp.ClientTimeout(total=120)
+    # one session with a keep-alive connection pool, so TLS handshakes are reused across years
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=30)
+    async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+        dfs = await asyncio.gather(
+            *[process_API_request(session, sem, year, station_id, datum=datum, verbose=verbose) for year in years]
+        )
+    return dict(zip(years, dfs))
 
-def download_data(fn, station_id, start_year, end_year, datum='MSL'):
+def _run(coro):
+    '''This function runs a coroutine to completion, also when called from a running event loop such as a Jupyter notebook.
+    Args:
+        coro (coroutine): The coroutine to run
+
+    Returns:
+        The result of the coroutine'''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # asyncio.run cannot be nested, so run the coroutine in a separate thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coro).result()
+
+def download_data(fn, station_id, start_year, end_year, datum='MSL', verbose=False, partition_by_year=False):
     '''This function iterates over the years defined by the user and retrieves the data.
     Args:
-        fn (str): filename to save output csv
+        fn (str): filename to save output, written as zstd compressed parquet if it ends with .parquet, else as csv.
+            With partition_by_year, the directory of the parquet dataset
         station_id (int): The station id to request the data from
         start_year (int): First year from which to request data
         end_year (int): Last year from which to request data
         datum (str): vertical reference datum, by default MSL
+        verbose (bool): If True, log every downloaded year
+        partition_by_year (bool): If True, write a parquet dataset partitioned by year to fn, see read_data
         backward_compatible (bool): If True, the output csv file will be formatted in the same way as the csv files used in previous years of the course.
     Retruns:
-        export_data (pandas dataframe): The data retrieved from the API request in csv format.'''
+        export_data (pandas series): The water levels retrieved from the API request, indexed by datetime.'''
     os.makedirs(os.path.dirname(fn), exist_ok=True)
 
-    # initiate response dictionary
-    retrieved_data = {}
-    
-    # iterate over years defined by user and retrieve data8531680 
-    for year in np.arange(start_year, end_year+1, dtype=np.int32):   
-        retrieved_data[year] = process_API_request(year, station_id, datum=datum)
+    # retrieve data for all years defined by user concurrently
+    years = range(start_year, end_year+1)
+    retrieved_data = _run(_gather_years(years, station_id, datum=datum, verbose=verbose))
     
-    # now iterate over retrieved data to merge datasets
-    df = pd.concat(retrieved_data.values())
-    df = df.rename(columns={' Water Level': 'waterlevel', 'Date Time': 'datetime'})
-    df = df.set_index('datetime', drop=True).sort_index()
-    drop_cols = [col for col in df.columns if col != 'waterlevel']
-    df = df.drop(drop_cols, axis=1, errors='ignore')
+    # merge the water levels of all years into one preallocated buffer,
+    # hourly tide gauge precision does not need float64
+    n = sum(len(waterlevel) for waterlevel in retrieved_data.values())
+    times = np.empty(n, dtype='datetime64[s]')
+    values = np.empty(n, dtype='f4')
+    k = 0
+    for waterlevel in retrieved_data.values():
+        times[k:k+len(waterlevel)] = waterlevel.index.values
+        values[k:k+len(waterlevel)] = waterlevel.values
+        k += len(waterlevel)
+    df = pd.Series(values, index=pd.DatetimeIndex(times, name='datetime'), name='waterlevel')
+    if not df.index.is_monotonic_increasing:
+        df = df.sort_index()
 
-    df.to_csv(fn)
-    print(f'data stored to {fn}')
+    if partition_by_year:
+        # partition by year so reading a single year only touches its own files, see read_data;
+        # remove partitions of earlier downloads so the dataset matches the returned data
+        if Path(fn).exists() and not Path(fn).is_dir():
+            raise NotADirectoryError(f'Cannot write partitioned dataset, {fn} is an existing file')
+        for partition in Path(fn).glob('year=*'):
+            shutil.rmtree(partition)
+        table = pa.Table.from_pandas(df.to_frame().reset_index().assign(year=df.index.year), preserve_index=False)
+        ds.write_dataset(
+            table,
+            base_dir=fn,
+            format='parquet',
+            partitioning=['year'],
+            partitioning_flavor='hive',
+            existing_data_behavior='overwrite_or_ignore',
+        )
+    elif Path(fn).suffix == '.parquet':
+        df.to_frame().to_parquet(fn, compression='zstd', engine='pyarrow')
+    else:
+        df.to_csv(fn)
+    logger.info(f'data stored to {fn}')
 
     return df
 
+def read_data(fn, year=None):
+    '''This function reads the water levels from a parquet dataset partitioned by year, as written by download_data.
+    Args:
+        fn (str): directory of the parquet dataset
+        year (int): If given, only the partition of this year is read
+
+    Returns:
+        waterlevel (pandas series): The water levels indexed by datetime'''
+    dataset = ds.dataset(fn, format='parquet', partitioning='hive')
+    year_filter = ds.field('year') == year if year is not None else None
+    df = dataset.to_table(columns=['datetime', 'waterlevel'], filter=year_filter).to_pandas()
+    return df.set_index('datetime')['waterlevel'].sort_index()
+
 
 if __name__ == '__main__':
     print('Busy...') 
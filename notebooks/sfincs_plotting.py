@@ -3,8 +3,8 @@ HydroMT-SFINCS utilities functions for plotting
 """
 
 from typing import Tuple
+import shutil
 import matplotlib.pyplot as plt
-import numpy as np
 import xarray as xr
 from hydromt_sfincs.plots import plot_basemap
 from IPython.display import HTML
@@ -38,14 +38,19 @@ def make_animation(
     cmap = 'BuPu',
     vmin=  0,
     vmax= 3,
+    ffmpeg_path: str = "./ffmpeg",
     ):
-    # check_install_ffmpeg()
+    # float32 is ample for water depths and halves the data pushed per frame
+    da_h = da_h.astype("float32")
 
-    def update_plot(i, da_h, cax_h):
-        da_h = da_h.isel(time=i)
-        t = da_h.time.dt.strftime("%d-%B-%Y %H:%M:%S").item()
-        ax.set_title(f"SFINCS water depth {t}")
-        cax_h.set_array(da_h.values.ravel())
+    # precompute frame data and titles once, outside the animation loop
+    da_frames = da_h.isel(time=slice(None, None, step))
+    frames_data = da_frames.values
+    times = da_frames.time.dt.strftime("%d-%B-%Y %H:%M:%S").values
+
+    def update_plot(i, cax_h):
+        ax.set_title(f"SFINCS water depth {times[i]}")
+        cax_h.set_array(frames_data[i].ravel())
 
     fig, ax = plot_basemap(
         ds = da_h.to_dataset(),
@@ -68,10 +73,23 @@ def make_animation(
     ani = animation.FuncAnimation(
         fig,
         update_plot,
-        frames=np.arange(0, da_h.time.size, step),
+        frames=range(len(frames_data)),
         interval=250,  # ms between frames
-        fargs=(da_h, cax_h,),
+        fargs=(cax_h,),
     )
 
-    # to show in notebook:
+    # to show in notebook as h264 video, much smaller than embedding every frame as png;
+    # fall back to the javascript player if no ffmpeg is available
+    ffmpeg_exe = shutil.which("ffmpeg")
+    if ffmpeg_exe is None:
+        try:
+            check_install_ffmpeg(path=ffmpeg_path)
+        except ImportError:
+            pass  # local_ffmpeg is not installed, use the javascript player
+        else:
+            ffmpeg_exe = shutil.which("ffmpeg", path=str(Path(ffmpeg_path).resolve()))
+    if ffmpeg_exe is not None:
+        with plt.rc_context({"animation.ffmpeg_path": ffmpeg_exe}):
+            if animation.writers.is_available("ffmpeg"):
+                return HTML(ani.to_html5_video(embed_limit=200))
     return HTML(ani.to_jshtml())
\ No newline at end of file
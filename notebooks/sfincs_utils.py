@@ -2,14 +2,19 @@
 HydroMT-SFINCS utilities functions
 """
 
+import functools
 import platform
 import subprocess
+import threading
 import zipfile
 from pathlib import Path
 from typing import Literal, Optional
 
 from hydromt_sfincs.sfincs_input import SfincsInput
 
+# file types that are already compressed and are stored as-is in model archives
+COMPRESSED_SUFFIXES = {".nc", ".tif", ".tiff", ".zip", ".gz", ".zst"}
+
 
 def run_sfincs(
     sfincs_inp: Path,
@@ -54,7 +59,19 @@ def run_sfincs(
             raise FileNotFoundError(f"sfincs_exe not found: {sfincs_exe}")
         cmd = [str(sfincs_exe)]
     elif run_method == "docker":
-        if subprocess.run(["docker", "stats", "--no-stream"]).returncode != 0:
+        try:
+            docker_running = (
+                subprocess.run(
+                    ["docker", "version", "--format", "{{.Server.Version}}"],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=5,
+                ).returncode
+                == 0
+            )
+        except subprocess.TimeoutExpired:
+            docker_running = False
+        if not docker_running:
             raise RuntimeError(
                 "Docker not running. Make sure Docker is installed and running."
             )
@@ -67,7 +84,10 @@ def run_sfincs(
             f"deltares/sfincs-cpu:{docker_tag}",
         ]
     elif run_method == "apptainer":
-        if subprocess.run(["apptainer", "version"]).returncode != 0:
+        apptainer_check = subprocess.run(
+            ["apptainer", "version"], stderr=subprocess.DEVNULL
+        )
+        if apptainer_check.returncode != 0:
             raise RuntimeError(
                 "Apptainer not found. Make sure it is installed, running and added to PATH."
             )
@@ -86,6 +106,7 @@ def run_sfincs(
     log_file = model_root / "sfincs_log.txt"
     # run & write log file
     print_log = False
+    simulation_stopped = False
     with subprocess.Popen(
         cmd,
         cwd=model_root,
@@ -94,17 +115,32 @@ def run_sfincs(
         universal_newlines=True,  # get string output instead of bytes
     ) as proc:
         with open(log_file, "w") as f:
+            lock = threading.Lock()
+
+            def write_line(line: str) -> None:
+                nonlocal simulation_stopped
+                if "Simulation stopped" in line:
+                    simulation_stopped = True
+                with lock:
+                    f.write(line)
+
+            def drain_stderr() -> None:
+                for line in proc.stderr:
+                    if verbose:
+                        print(line.rstrip("\n"))
+                    write_line(line)
+
+            # drain stderr concurrently so a full stderr pipe cannot block the model
+            stderr_thread = threading.Thread(target=drain_stderr, daemon=True)
+            stderr_thread.start()
             for line in proc.stdout:
                 if verbose and not print_log:
                     # start printing log after first line with only "-"
                     print_log = set(line.strip()) == set(["-"])
                 if print_log:
                     print(line.rstrip("\n"))
-                f.write(line)
-            for line in proc.stderr:
-                if verbose:
-                    print(line.rstrip("\n"))
-                f.write(line)
+                write_line(line)
+            stderr_thread.join()
         proc.wait()
         return_code = proc.returncode
 
@@ -116,17 +152,29 @@ def run_sfincs(
     elif return_code != 0:
         raise RuntimeError(f"SFINCS run failed with return code {return_code}")
 
-    # check if "Simulation stopped" in log file
-    with open(log_file, "r") as f:
-        log = f.read()
-        if "Simulation stopped" in log:
-            raise RuntimeError(
-                f"SFINCS run failed. Check log file for details: {log_file}"
-            )
+    # check if "Simulation stopped" was logged
+    if simulation_stopped:
+        raise RuntimeError(
+            f"SFINCS run failed. Check log file for details: {log_file}"
+        )
 
     return None
 
 
+@functools.lru_cache(maxsize=128)
+def _load_inp(path_str: str, mtime_ns: int) -> dict:
+    """Parse a sfincs.inp file, cached per path and modification time."""
+    return SfincsInput.from_file(Path(path_str)).to_dict()
+
+
+def _read_inp(sfincs_inp: Path) -> dict:
+    """Read a sfincs.inp file as dictionary, parsing each file version only once."""
+    sfincs_inp = Path(sfincs_inp).resolve()
+    # include mtime in the cache key so edits to the file are picked up,
+    # and return a copy so callers cannot modify the cached entry
+    return dict(_load_inp(str(sfincs_inp), sfincs_inp.stat().st_mtime_ns))
+
+
 def get_sfincs_basemodel_root(sfincs_inp: Path) -> Path:
     """Get folder with SFINCS static files.
 
@@ -140,8 +188,7 @@ def get_sfincs_basemodel_root(sfincs_inp: Path) -> Path:
     Path
         Path to parent directory with static files.
     """
-    inp = SfincsInput.from_file(sfincs_inp)
-    config = inp.to_dict()
+    config = _read_inp(sfincs_inp)
     n = 0
     for key, value in config.items():
         if "file" in key and "../" in value:
@@ -179,21 +226,34 @@ def create_sfincs_model_archive(
         except Exception:
             raise FileExistsError(f"Could not remove existing zipfile: {zip_filename}")
 
+    # collect files and find folder with static files in a single pass
     files = [sfincs_inp]
-    base_folder = get_sfincs_basemodel_root(sfincs_inp)
-    inp = SfincsInput.from_file(sfincs_inp)
-    config = inp.to_dict()
+    n = 0
+    config = _read_inp(sfincs_inp)
     for key, value in config.items():
-        if "file" in key:
-            file_path = Path(sfincs_inp.parent, value).resolve()
-            if file_path.exists():
-                files.append(file_path)
-            else:
-                # raise FileNotFoundError(f"Could not find file: {key} = {value}")
-                print(f"WARNING: Could not find file: {key} = {value}")
+        if "file" not in key:
+            continue
+        if "../" in value:
+            n = max(n, value.count("../"))
+        file_path = Path(sfincs_inp.parent, value).resolve()
+        if file_path.exists():
+            files.append(file_path)
+        else:
+            # raise FileNotFoundError(f"Could not find file: {key} = {value}")
+            print(f"WARNING: Could not find file: {key} = {value}")
+    base_folder = sfincs_inp.parents[n]
     # create zip archive with base_folder as root
     with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
         for file in files:
-            zipf.write(file, arcname=file.relative_to(base_folder))
+            if file.suffix.lower() in COMPRESSED_SUFFIXES:
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            zipf.write(
+                file,
+                arcname=file.relative_to(base_folder),
+                compress_type=compress_type,
+                compresslevel=1,
+            )
 
     return zip_filename